@@ -1,10 +1,82 @@
+import copy
 import os
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import *
 
 import torch
 
 
+SAVE_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+PENDING_SAVES = []
+
+# spk_embed_dim and emb_channels are overwritten per model
+SR_CONFIGS = {
+    "32k": {
+        "spec_channels": 513,
+        "segment_size": 32,
+        "inter_channels": 192,
+        "hidden_channels": 192,
+        "filter_channels": 768,
+        "n_heads": 2,
+        "n_layers": 6,
+        "kernel_size": 3,
+        "p_dropout": 0,
+        "resblock": "1",
+        "resblock_kernel_sizes": [3, 7, 11],
+        "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+        "upsample_rates": [10, 4, 2, 2, 2],
+        "upsample_initial_channel": 512,
+        "upsample_kernel_sizes": [16, 16, 4, 4, 4],
+        "spk_embed_dim": 109,
+        "gin_channels": 256,
+        "emb_channels": 256,
+        "sr": 32000,
+    },
+    "40k": {
+        "spec_channels": 1025,
+        "segment_size": 32,
+        "inter_channels": 192,
+        "hidden_channels": 192,
+        "filter_channels": 768,
+        "n_heads": 2,
+        "n_layers": 6,
+        "kernel_size": 3,
+        "p_dropout": 0,
+        "resblock": "1",
+        "resblock_kernel_sizes": [3, 7, 11],
+        "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+        "upsample_rates": [10, 10, 2, 2],
+        "upsample_initial_channel": 512,
+        "upsample_kernel_sizes": [16, 16, 4, 4],
+        "spk_embed_dim": 109,
+        "gin_channels": 256,
+        "emb_channels": 256,
+        "sr": 40000,
+    },
+    "48k": {
+        "spec_channels": 1025,
+        "segment_size": 32,
+        "inter_channels": 192,
+        "hidden_channels": 192,
+        "filter_channels": 768,
+        "n_heads": 2,
+        "n_layers": 6,
+        "kernel_size": 3,
+        "p_dropout": 0,
+        "resblock": "1",
+        "resblock_kernel_sizes": [3, 7, 11],
+        "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+        "upsample_rates": [10, 6, 2, 2, 2],
+        "upsample_initial_channel": 512,
+        "upsample_kernel_sizes": [16, 16, 4, 4, 4],
+        "spk_embed_dim": 109,
+        "gin_channels": 256,
+        "emb_channels": 256,
+        "sr": 48000,
+    },
+}
+
+
 def write_config(state_dict: Dict[str, Any], cfg: Dict[str, Any]):
     state_dict["config"] = []
     for key, x in cfg.items():
@@ -23,87 +95,16 @@ def create_trained_model(
     epoch: int,
     speaker_info: Optional[dict[str, int]]
 ):
-    state_dict = OrderedDict()
+    state_dict = {}
     state_dict["weight"] = {}
     for key in weights.keys():
         if "enc_q" in key:
             continue
         state_dict["weight"][key] = weights[key].half()
-    if sr == "40k":
-        write_config(
-            state_dict,
-            {
-                "spec_channels": 1025,
-                "segment_size": 32,
-                "inter_channels": 192,
-                "hidden_channels": 192,
-                "filter_channels": 768,
-                "n_heads": 2,
-                "n_layers": 6,
-                "kernel_size": 3,
-                "p_dropout": 0,
-                "resblock": "1",
-                "resblock_kernel_sizes": [3, 7, 11],
-                "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
-                "upsample_rates": [10, 10, 2, 2],
-                "upsample_initial_channel": 512,
-                "upsample_kernel_sizes": [16, 16, 4, 4],
-                "spk_embed_dim": 109 if speaker_info is None else len(speaker_info),
-                "gin_channels": 256,
-                "emb_channels": emb_ch,
-                "sr": 40000,
-            },
-        )
-    elif sr == "48k":
-        write_config(
-            state_dict,
-            {
-                "spec_channels": 1025,
-                "segment_size": 32,
-                "inter_channels": 192,
-                "hidden_channels": 192,
-                "filter_channels": 768,
-                "n_heads": 2,
-                "n_layers": 6,
-                "kernel_size": 3,
-                "p_dropout": 0,
-                "resblock": "1",
-                "resblock_kernel_sizes": [3, 7, 11],
-                "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
-                "upsample_rates": [10, 6, 2, 2, 2],
-                "upsample_initial_channel": 512,
-                "upsample_kernel_sizes": [16, 16, 4, 4, 4],
-                "spk_embed_dim": 109 if speaker_info is None else len(speaker_info),
-                "gin_channels": 256,
-                "emb_channels": emb_ch,
-                "sr": 48000,
-            },
-        )
-    elif sr == "32k":
-        write_config(
-            state_dict,
-            {
-                "spec_channels": 513,
-                "segment_size": 32,
-                "inter_channels": 192,
-                "hidden_channels": 192,
-                "filter_channels": 768,
-                "n_heads": 2,
-                "n_layers": 6,
-                "kernel_size": 3,
-                "p_dropout": 0,
-                "resblock": "1",
-                "resblock_kernel_sizes": [3, 7, 11],
-                "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
-                "upsample_rates": [10, 4, 2, 2, 2],
-                "upsample_initial_channel": 512,
-                "upsample_kernel_sizes": [16, 16, 4, 4, 4],
-                "spk_embed_dim": 109 if speaker_info is None else len(speaker_info),
-                "gin_channels": 256,
-                "emb_channels": emb_ch,
-                "sr": 32000,
-            },
-        )
+    cfg = copy.deepcopy(SR_CONFIGS[sr])
+    cfg["spk_embed_dim"] = 109 if speaker_info is None else len(speaker_info)
+    cfg["emb_channels"] = emb_ch
+    write_config(state_dict, cfg)
     state_dict["version"] = version
     state_dict["info"] = f"{epoch}epoch"
     state_dict["sr"] = sr
@@ -115,6 +116,15 @@ def create_trained_model(
     return state_dict
 
 
+def snapshot(value: torch.Tensor):
+    if value.is_cuda:
+        # cast on the GPU, then copy to CPU; the caller synchronizes
+        return value.detach().half().to("cpu", non_blocking=True)
+    # a blocking copy, so that the background write never sees a partially
+    # copied (MPS) or still trained (CPU) tensor
+    return value.detach().to("cpu", torch.float16, copy=True)
+
+
 def save(
     model,
     version: Literal["v1", "v2"],
@@ -127,6 +137,11 @@ def save(
     epoch: int,
     speaker_info: Optional[dict[str, int]]
 ):
+    """
+    Snapshot the weights to CPU and write the checkpoint on a background thread,
+    so that training can continue while it is serialized. Call `wait_for_saves`
+    before relying on the file.
+    """
     if hasattr(model, "module"):
         state_dict = model.module.state_dict()
     else:
@@ -134,8 +149,53 @@ def save(
 
     print(f"save: emb_name: {emb_name} {emb_ch}")
 
+    # raise an invalid sr here rather than later on the save thread
+    if sr not in SR_CONFIGS:
+        raise KeyError(sr)
+
+    # finish the previous write first, so that at most one snapshot of the
+    # weights is held in host memory
+    wait_for_saves()
+
+    weights = {
+        key: snapshot(value)
+        for key, value in state_dict.items()
+        if "enc_q" not in key
+    }
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+    future = SAVE_EXECUTOR.submit(
+        write_trained_model,
+        weights,
+        version,
+        sr,
+        f0,
+        emb_name,
+        emb_ch,
+        emb_output_layer,
+        filepath,
+        epoch,
+        speaker_info,
+    )
+    PENDING_SAVES.append(future)
+    return future
+
+
+def write_trained_model(
+    weights: Dict[str, Any],
+    version: Literal["v1", "v2"],
+    sr: str,
+    f0: bool,
+    emb_name: str,
+    emb_ch: int,
+    emb_output_layer: int,
+    filepath: str,
+    epoch: int,
+    speaker_info: Optional[dict[str, int]]
+):
     state_dict = create_trained_model(
-        state_dict,
+        weights,
         version,
         sr,
         f0,
@@ -147,3 +207,15 @@ def save(
     )
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
     torch.save(state_dict, filepath)
+
+
+def wait_for_saves():
+    # re-raises the first error of a background save
+    while len(PENDING_SAVES) > 0:
+        PENDING_SAVES.pop(0).result()
+
+
+def discard_saves():
+    # forget the writes of a previous training run that died before waiting
+    # on them, so that their errors don't surface in an unrelated run
+    PENDING_SAVES.clear()
@@ -58,8 +58,16 @@ class TrainConfig(BaseModel):
     model: TrainConfigModel
 
 
+class DatasetShardItem(BaseModel):
+    path: str
+    offset: int
+    length: int
+    sampling_rate: int
+
+
 class DatasetMetaItem(BaseModel):
     gt_wav: str
+    gt_wav_shard: Optional[DatasetShardItem]
     co256: str
     f0: Optional[str]
     f0nsf: Optional[str]
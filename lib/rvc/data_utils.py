@@ -1,5 +1,6 @@
 import os
 import traceback
+from functools import lru_cache
 
 import numpy as np
 import torch
@@ -10,6 +11,26 @@ from .mel_processing import spectrogram_torch
 from .utils import load_wav_to_torch
 
 
+@lru_cache(maxsize=256)
+def load_npy(path: str):
+    # memory-mapped, so only the rows that are used are read and later epochs
+    # are served from the page cache
+    return np.load(path, mmap_mode="r")
+
+
+@lru_cache(maxsize=None)
+def load_shard(path: str):
+    return np.memmap(path, dtype=np.float32, mode="r")
+
+
+def load_gt_wav(data: DatasetMetaItem):
+    if data.gt_wav_shard is None:
+        return load_wav_to_torch(data.gt_wav)
+    shard = data.gt_wav_shard
+    audio = load_shard(shard.path)[shard.offset : shard.offset + shard.length]
+    return torch.from_numpy(np.array(audio)), shard.sampling_rate
+
+
 class TextAudioLoader(torch.utils.data.Dataset):
     """
     1) loads audio, text pairs
@@ -28,6 +49,7 @@ class TextAudioLoader(torch.utils.data.Dataset):
         self.min_text_len = getattr(data, "min_text_len", 1)
         self.max_text_len = getattr(data, "max_text_len", 5000)
         self._filter()
+        self.items = list(self.dataset_meta.files.values())
 
     def _filter(self):
         """
@@ -53,12 +75,11 @@ class TextAudioLoader(torch.utils.data.Dataset):
 
     def get_audio_text_pair(self, data: DatasetMetaItem):
         # separate filename and text
-        file = data.gt_wav
         phone = data.co256
         dv = data.speaker_id
 
         phone = self.get_labels(phone)
-        spec, wav = self.get_audio(file)
+        spec, wav = self.get_audio(data)
         dv = self.get_sid(dv)
 
         len_phone = phone.size()[0]
@@ -72,15 +93,15 @@ class TextAudioLoader(torch.utils.data.Dataset):
         return (spec, wav, phone, dv)
 
     def get_labels(self, phone):
-        phone = np.load(phone)
-        phone = np.repeat(phone, 2, axis=0)
-        n_num = min(phone.shape[0], 900)  # DistributedBucketSampler
-        phone = phone[:n_num, :]
+        phone = load_npy(phone)
+        n_num = min(phone.shape[0] * 2, 900)  # DistributedBucketSampler
+        phone = np.repeat(phone[: (n_num + 1) // 2], 2, axis=0)[:n_num, :]
         phone = torch.FloatTensor(phone)
         return phone
 
-    def get_audio(self, filename):
-        audio, sampling_rate = load_wav_to_torch(filename)
+    def get_audio(self, data: DatasetMetaItem):
+        filename = data.gt_wav
+        audio, sampling_rate = load_gt_wav(data)
         if sampling_rate != self.sampling_rate:
             raise ValueError(
                 "{} SR doesn't match target {} SR".format(
@@ -119,8 +140,7 @@ class TextAudioLoader(torch.utils.data.Dataset):
         return spec, audio_norm
 
     def __getitem__(self, index):
-        _, data = list(self.dataset_meta.files.items())[index]
-        return self.get_audio_text_pair(data)
+        return self.get_audio_text_pair(self.items[index])
 
     def __len__(self):
         return len(self.dataset_meta.files)
@@ -144,6 +164,7 @@ class TextAudioLoaderMultiNSFsid(torch.utils.data.Dataset):
         self.min_text_len = getattr(data, "min_text_len", 1)
         self.max_text_len = getattr(data, "max_text_len", 5000)
         self._filter()
+        self.items = list(self.dataset_meta.files.values())
 
     def _filter(self):
         """
@@ -169,14 +190,13 @@ class TextAudioLoaderMultiNSFsid(torch.utils.data.Dataset):
 
     def get_audio_text_pair(self, data: DatasetMetaItem):
         # separate filename and text
-        file = data.gt_wav
         phone = data.co256
         pitch = data.f0
         pitchf = data.f0nsf
         dv = data.speaker_id
 
         phone, pitch, pitchf = self.get_labels(phone, pitch, pitchf)
-        spec, wav = self.get_audio(file)
+        spec, wav = self.get_audio(data)
         dv = self.get_sid(dv)
 
         len_phone = phone.size()[0]
@@ -197,22 +217,22 @@ class TextAudioLoaderMultiNSFsid(torch.utils.data.Dataset):
         return (spec, wav, phone, pitch, pitchf, dv)
 
     def get_labels(self, phone, pitch, pitchf):
-        phone = np.load(phone)
-        phone = np.repeat(phone, 2, axis=0)
-        pitch = np.load(pitch)
-        pitchf = np.load(pitchf)
-        n_num = min(phone.shape[0], 900)  # DistributedBucketSampler
+        phone = load_npy(phone)
+        pitch = load_npy(pitch)
+        pitchf = load_npy(pitchf)
+        n_num = min(phone.shape[0] * 2, 900)  # DistributedBucketSampler
         # print(234,phone.shape,pitch.shape)
-        phone = phone[:n_num, :]
-        pitch = pitch[:n_num]
-        pitchf = pitchf[:n_num]
+        phone = np.repeat(phone[: (n_num + 1) // 2], 2, axis=0)[:n_num, :]
+        pitch = np.array(pitch[:n_num])
+        pitchf = np.array(pitchf[:n_num])
         phone = torch.FloatTensor(phone)
         pitch = torch.LongTensor(pitch)
         pitchf = torch.FloatTensor(pitchf)
         return phone, pitch, pitchf
 
-    def get_audio(self, filename):
-        audio, sampling_rate = load_wav_to_torch(filename)
+    def get_audio(self, data: DatasetMetaItem):
+        filename = data.gt_wav
+        audio, sampling_rate = load_gt_wav(data)
         if sampling_rate != self.sampling_rate:
             raise ValueError(
                 "{} SR doesn't match target {} SR".format(
@@ -251,8 +271,7 @@ class TextAudioLoaderMultiNSFsid(torch.utils.data.Dataset):
         return spec, audio_norm
 
     def __getitem__(self, index):
-        _, data = list(self.dataset_meta.files.items())[index]
-        return self.get_audio_text_pair(data)
+        return self.get_audio_text_pair(self.items[index])
 
     def __len__(self):
         return len(self.dataset_meta.files)
@@ -1,7 +1,6 @@
-import multiprocessing as mp
 import os
 import traceback
-from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from typing import *
 
 import numpy as np
@@ -68,11 +67,13 @@ def processor(
     device: torch.device,
     embedder_path: str,
     embedder_load_from: str,
-    embedding_channel: bool,
+    embedding_channel: int,
     embedding_output_layer: int,
     wav_dir: str,
     out_dir: str,
     process_id: int,
+    gpu_lock=None,
+    progress=None,
 ):
     half_support = (
         device.type == "cuda" and torch.cuda.get_device_capability(device)[0] >= 5.3
@@ -98,48 +99,49 @@ def processor(
                 is_normalize = False if cfg is None else cfg.task.normalize
                 feats = readwave(wav_filepath, normalize=is_normalize)
                 padding_mask = torch.BoolTensor(feats.shape).fill_(False)
-                if isinstance(model, tuple):
-                    feats = model[0](
-                        feats.squeeze(0).squeeze(0).to(device),
-                        return_tensors="pt",
-                        sampling_rate=16000,
-                    )
-                    if half_support:
-                        feats = feats.input_values.to(device).half()
-                    else:
-                        feats = feats.input_values.to(device).float()
-
-                    with torch.no_grad():
+                with gpu_lock or nullcontext():
+                    if isinstance(model, tuple):
+                        feats = model[0](
+                            feats.squeeze(0).squeeze(0).to(device),
+                            return_tensors="pt",
+                            sampling_rate=16000,
+                        )
                         if half_support:
-                            if is_feats_dim_768:
-                                feats = model[1](feats).last_hidden_state
-                            else:
-                                feats = model[1](feats).extract_features
+                            feats = feats.input_values.to(device).half()
                         else:
+                            feats = feats.input_values.to(device).float()
+
+                        with torch.no_grad():
+                            if half_support:
+                                if is_feats_dim_768:
+                                    feats = model[1](feats).last_hidden_state
+                                else:
+                                    feats = model[1](feats).extract_features
+                            else:
+                                if is_feats_dim_768:
+                                    feats = model[1].float()(feats).last_hidden_state
+                                else:
+                                    feats = model[1].float()(feats).extract_features
+                    else:
+                        inputs = {
+                            "source": feats.half().to(device)
+                            if half_support
+                            else feats.to(device),
+                            "padding_mask": padding_mask.to(device),
+                            "output_layer": embedding_output_layer,
+                        }
+
+                        # なんかまだこの時点でfloat16なので改めて変換
+                        if not half_support:
+                            model = model.float()
+                            inputs["source"] = inputs["source"].float()
+
+                        with torch.no_grad():
+                            logits = model.extract_features(**inputs)
                             if is_feats_dim_768:
-                                feats = model[1].float()(feats).last_hidden_state
+                                feats = logits[0]
                             else:
-                                feats = model[1].float()(feats).extract_features
-                else:
-                    inputs = {
-                        "source": feats.half().to(device)
-                        if half_support
-                        else feats.to(device),
-                        "padding_mask": padding_mask.to(device),
-                        "output_layer": embedding_output_layer,
-                    }
-
-                    # なんかまだこの時点でfloat16なので改めて変換
-                    if not half_support:
-                        model = model.float()
-                        inputs["source"] = inputs["source"].float()
-
-                    with torch.no_grad():
-                        logits = model.extract_features(**inputs)
-                        if is_feats_dim_768:
-                            feats = logits[0]
-                        else:
-                            feats = model.final_proj(logits[0])
+                                feats = model.final_proj(logits[0])
 
                 feats = feats.squeeze(0).float().cpu().numpy()
                 if np.isnan(feats).sum() == 0:
@@ -149,38 +151,56 @@ def processor(
         except Exception as e:
             print(f"Error: {e} {file}")
             traceback.print_exc()
+        finally:
+            if progress is not None:
+                progress.put(1)
 
 
-def run(
-    training_dir: str,
+def queue_processor(
+    queue,
+    device: torch.device,
     embedder_path: str,
     embedder_load_from: str,
     embedding_channel: int,
     embedding_output_layer: int,
-    gpu_ids: List[int],
-    device: Optional[Union[torch.device, str]] = None,
+    training_dir: str,
+    process_id: int,
+    gpu_lock=None,
+    progress=None,
 ):
-    wav_dir = os.path.join(training_dir, "1_16k_wavs")
-    out_dir = os.path.join(training_dir, "3_feature256")
+    # consume clip names until the None sentinel arrives
+    todo = iter(queue.get, None)
+    try:
+        error = processor(
+            todo,
+            device,
+            embedder_path,
+            embedder_load_from,
+            embedding_channel,
+            embedding_output_layer,
+            os.path.join(training_dir, "1_16k_wavs"),
+            os.path.join(training_dir, "3_feature256"),
+            process_id,
+            gpu_lock,
+            progress,
+        )
+        if error is not None:
+            raise Exception(error)
+    finally:
+        # keep draining so that the producer never blocks on a full queue
+        for _ in todo:
+            pass
 
+
+def get_devices(
+    gpu_ids: List[int], device: Optional[Union[torch.device, str]] = None
+) -> Optional[List[torch.device]]:
     num_gpus = len(gpu_ids)
 
     for gpu_id in gpu_ids:
         if num_gpus < gpu_id + 1:
             print(f"GPU {gpu_id} is not available")
-            return
-
-    if os.path.exists(out_dir):
-        return
-
-    os.makedirs(out_dir, exist_ok=True)
-
-    todo = [
-        os.path.join(dir, f)
-        for dir in sorted(list(os.listdir(wav_dir)))
-        if os.path.isdir(os.path.join(wav_dir, dir))
-        for f in sorted(list(os.listdir(os.path.join(wav_dir, dir))))
-    ]
+            return None
 
     if device is not None:
         if type(device) == str:
@@ -189,29 +209,6 @@ def run(
             device = torch.device(
                 "cpu"
             )  # Mac(MPS) crashes when multiprocess, so change to CPU.
-        processor(
-            todo,
-            device,
-            embedder_path,
-            embedder_load_from,
-            embedding_channel,
-            embedding_output_layer,
-            wav_dir,
-            out_dir,
-            process_id=0,
-        )
-    else:
-        with ProcessPoolExecutor(mp_context=mp.get_context("spawn")) as executor:
-            for i, id in enumerate(gpu_ids):
-                executor.submit(
-                    processor,
-                    todo[i::num_gpus],
-                    torch.device(f"cuda:{id}"),
-                    embedder_path,
-                    embedder_load_from,
-                    embedding_channel,
-                    embedding_output_layer,
-                    wav_dir,
-                    out_dir,
-                    process_id=i,
-                )
+        return [device]
+
+    return [torch.device(f"cuda:{id}") for id in gpu_ids]
@@ -53,6 +53,7 @@ def norm_write(
         16000,
         tmp_audio.astype(np.float32),
     )
+    return os.path.join(f"{speaker_id:05}", f"{idx0}_{idx1}.wav")
 
 
 def write_mute(
@@ -76,6 +77,23 @@ def write_mute(
         16000,
         tmp_audio.astype(np.float32),
     )
+    return os.path.join(f"{speaker_id:05}", "mute.wav")
+
+
+def emit(queues: Sequence[Any], name: str):
+    # notify the downstream stages that a 16k clip is ready
+    for queue in queues:
+        queue.put(name)
+
+
+def list_clips(waves16k_dir: str):
+    return [
+        os.path.join(speaker_dir, name)
+        for speaker_dir in sorted(os.listdir(waves16k_dir))
+        if os.path.isdir(os.path.join(waves16k_dir, speaker_dir))
+        for name in sorted(os.listdir(os.path.join(waves16k_dir, speaker_dir)))
+        if name.endswith(".wav")
+    ]
 
 
 def pipeline(
@@ -86,6 +104,9 @@ def pipeline(
     sampling_rate: int,
     is_normalize: bool,
     process_id: int = 0,
+    queues: Sequence[Any] = (),
+    progress: Optional[Any] = None,  # receives 1 for every finished file
+    stop: Optional[Any] = None,  # an Event that cancels the remaining files
 ):
     per = 3.7
     overlap = 0.3
@@ -96,6 +117,8 @@ def pipeline(
     bh, ah = signal.butter(N=5, Wn=48, btype="high", fs=sampling_rate)
 
     for index, (wave_filename, speaker_id) in tqdm(datasets, position=1 + process_id):
+        if stop is not None and stop.is_set():
+            break
         audio = load_audio(wave_filename, sampling_rate)
         audio = signal.lfilter(bh, ah, audio)
 
@@ -107,7 +130,7 @@ def pipeline(
                 i += 1
                 if len(audio[start:]) > tail * sampling_rate:
                     tmp_audio = audio[start : start + int(per * sampling_rate)]
-                    norm_write(
+                    name = norm_write(
                         tmp_audio,
                         index,
                         idx1,
@@ -119,11 +142,12 @@ def pipeline(
                         alpha,
                         is_normalize,
                     )
+                    emit(queues, name)
                     idx1 += 1
                 else:
                     tmp_audio = audio[start:]
                     break
-            norm_write(
+            name = norm_write(
                 tmp_audio,
                 index,
                 idx1,
@@ -135,8 +159,12 @@ def pipeline(
                 alpha,
                 is_normalize,
             )
+            emit(queues, name)
             idx1 += 1
 
+        if progress is not None:
+            progress.put(1)
+
 
 def preprocess_audio(
     datasets: List[Tuple[str, int]],  # List[(path, speaker_id)]
@@ -145,10 +173,17 @@ def preprocess_audio(
     training_dir: str,
     is_normalize: bool,
     mute_wav_path: str,
+    queues: Sequence[Any] = (),  # receive each 16k clip as soon as it is written
+    progress: Optional[Any] = None,  # receives 1 for every finished file
+    stop: Optional[Any] = None,  # an Event that cancels the remaining files
 ):
     waves_dir = os.path.join(training_dir, "0_gt_wavs")
     waves16k_dir = os.path.join(training_dir, "1_16k_wavs")
     if os.path.exists(waves_dir) and os.path.exists(waves16k_dir):
+        for name in list_clips(waves16k_dir):
+            if stop is not None and stop.is_set():
+                break
+            emit(queues, name)
         return
 
     for speaker_id in set([spk for _, spk in datasets]):
@@ -167,6 +202,7 @@ def preprocess_audio(
         f"len(all): {len(all)}, sum(process_all_nums): {sum(process_all_nums)}"
     )
 
+    futures = []
     with ProcessPoolExecutor(max_workers=num_processes) as executor:
         all_index = 0
         for i in range(num_processes):
@@ -179,7 +215,7 @@ def preprocess_audio(
                 hop_size=15,
                 max_sil_kept=500,
             )
-            executor.submit(
+            future = executor.submit(
                 pipeline,
                 slicer,
                 data,
@@ -188,8 +224,22 @@ def preprocess_audio(
                 sampling_rate,
                 is_normalize,
                 process_id=i,
+                queues=queues,
+                progress=progress,
+                stop=stop,
             )
+            futures.append(future)
             all_index += process_all_nums[i]
 
+    # raise if any worker failed, so that a partial output is never stamped
+    for future in futures:
+        future.result()
+
+    if stop is not None and stop.is_set():
+        return
+
     for speaker_id in set([spk for _, spk in datasets]):
-        write_mute(mute_wav_path, speaker_id, waves_dir, waves16k_dir, sampling_rate)
+        name = write_mute(
+            mute_wav_path, speaker_id, waves_dir, waves16k_dir, sampling_rate
+        )
+        emit(queues, name)
@@ -0,0 +1,269 @@
+import hashlib
+import multiprocessing as mp
+import os
+import shutil
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from queue import Empty
+from typing import *
+
+import torch
+
+from . import extract_f0, extract_feature, split
+
+
+def hash_stage(*keys: Any, datasets: Sequence[Tuple[str, int]] = ()):
+    h = hashlib.blake2b(digest_size=16)
+    for key in keys:
+        h.update(repr(key).encode())
+    for path, speaker_id in datasets:
+        stat = os.stat(path)
+        h.update(repr((path, speaker_id, stat.st_mtime_ns, stat.st_size)).encode())
+    return h.hexdigest()
+
+
+def read_stamp(stage_dir: str):
+    try:
+        with open(os.path.join(stage_dir, ".stamp")) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def write_stamp(stage_dir: str, stamp: str):
+    os.makedirs(stage_dir, exist_ok=True)
+    with open(os.path.join(stage_dir, ".stamp"), "w") as f:
+        f.write(stamp)
+
+
+def remove_dirs(*dirs: str):
+    for dir in dirs:
+        if os.path.exists(dir):
+            shutil.rmtree(dir)
+
+
+def run(
+    datasets: List[Tuple[str, int]],  # List[(path, speaker_id)]
+    sampling_rate: int,
+    num_processes: int,
+    training_dir: str,
+    is_normalize: bool,
+    mute_wav_path: str,
+    f0: bool,
+    f0_method: str,
+    embedder_path: str,
+    embedder_load_from: str,
+    embedding_channel: int,
+    embedding_output_layer: int,
+    gpu_ids: List[int],
+    device: Optional[Union[torch.device, str]] = None,
+):
+    """
+    Preprocess the dataset and extract f0 and features in one streaming pass.
+    Every 16k clip written by the preprocessing workers is queued to the f0 and
+    feature extraction workers, so the stages overlap instead of running one
+    after another. Yields status messages while the stages are running.
+    """
+    devices = extract_feature.get_devices(gpu_ids, device) or []
+    # preprocessing and f0 extraction each start this many workers
+    num_processes = max(1, min(num_processes, mp.cpu_count() - 1))
+
+    waves_dir = os.path.join(training_dir, "0_gt_wavs")
+    waves16k_dir = os.path.join(training_dir, "1_16k_wavs")
+    f0_dir = os.path.join(training_dir, "2a_f0")
+    f0nsf_dir = os.path.join(training_dir, "2b_f0nsf")
+    feature_dir = os.path.join(training_dir, "3_feature256")
+
+    # each stage is skipped only when its stamp matches the current inputs
+    preprocess_stamp = hash_stage(
+        sampling_rate, is_normalize, mute_wav_path, datasets=datasets
+    )
+    f0_stamp = hash_stage(preprocess_stamp, f0_method)
+    feature_stamp = hash_stage(
+        preprocess_stamp, embedder_path, embedding_channel, embedding_output_layer
+    )
+
+    run_preprocess = read_stamp(waves_dir) != preprocess_stamp
+    if run_preprocess:
+        # the clips will be regenerated, so all derived outputs are stale
+        remove_dirs(waves_dir, waves16k_dir, f0_dir, f0nsf_dir, feature_dir)
+
+    # an unstamped stage directory is a partial run and is resumed file by file
+    run_f0 = f0 and read_stamp(f0_dir) != f0_stamp
+    if run_f0 and read_stamp(f0_dir) is not None:
+        remove_dirs(f0_dir, f0nsf_dir)
+
+    run_feature = len(devices) > 0 and read_stamp(feature_dir) != feature_stamp
+    if run_feature and read_stamp(feature_dir) is not None:
+        remove_dirs(feature_dir)
+
+    stages = []  # List[(queue, num_consumers)]
+    futures = {}  # Dict[Future, stage name]
+    with mp.Manager() as manager, ProcessPoolExecutor(
+        max_workers=max(1, num_processes + len(devices)),
+        mp_context=mp.get_context("spawn"),
+    ) as executor:
+        # crepe runs on cuda:0, so serialize it with the feature worker there
+        gpu_lock = None
+        if (
+            run_f0
+            and f0_method in ["crepe", "mangio-crepe"]
+            and torch.cuda.is_available()
+        ):
+            gpu_lock = manager.Lock()
+
+        # workers put 1 on their stage's queue for every finished item
+        progress = {
+            "preprocess": manager.Queue(),
+            "f0": manager.Queue(),
+            "features": manager.Queue(),
+        }
+        counts = dict.fromkeys(progress, 0)
+        # set on cancel or error, so that the preprocessing workers stop early
+        stop = manager.Event()
+        num_clips = "?"  # unknown until preprocessing has finished
+
+        if run_f0:
+            queue = manager.Queue(maxsize=num_processes * 2)
+            stages.append((queue, num_processes))
+            for i in range(num_processes):
+                future = executor.submit(
+                    extract_f0.queue_processor,
+                    queue,
+                    training_dir,
+                    f0_method,
+                    process_id=i,
+                    gpu_lock=gpu_lock,
+                    progress=progress["f0"],
+                )
+                futures[future] = "f0"
+
+        if run_feature:
+            # room for every consumer's sentinel, which abort() relies on
+            queue = manager.Queue(maxsize=max(num_processes, len(devices)) * 2)
+            stages.append((queue, len(devices)))
+            for i, device in enumerate(devices):
+                future = executor.submit(
+                    extract_feature.queue_processor,
+                    queue,
+                    device,
+                    embedder_path,
+                    embedder_load_from,
+                    embedding_channel,
+                    embedding_output_layer,
+                    training_dir,
+                    process_id=num_processes + i,
+                    gpu_lock=gpu_lock if device == torch.device("cuda:0") else None,
+                    progress=progress["features"],
+                )
+                futures[future] = "features"
+
+        def preprocess():
+            try:
+                split.preprocess_audio(
+                    datasets,
+                    sampling_rate,
+                    num_processes,
+                    training_dir,
+                    is_normalize,
+                    mute_wav_path,
+                    queues=[queue for queue, _ in stages],
+                    progress=progress["preprocess"],
+                    stop=stop,
+                )
+            finally:
+                for queue, num_consumers in stages:
+                    for _ in range(num_consumers):
+                        queue.put(None)
+
+        def status():
+            for name, queue in progress.items():
+                while True:
+                    try:
+                        counts[name] += queue.get_nowait()
+                    except Empty:
+                        break
+            messages = []
+            if run_preprocess:
+                messages.append(
+                    f"Preprocessing: {counts['preprocess']}/{len(datasets)} files"
+                )
+            if run_f0:
+                messages.append(f"Extracting f0: {counts['f0']}/{num_clips} clips")
+            if run_feature:
+                messages.append(
+                    f"Extracting features: {counts['features']}/{num_clips} clips"
+                )
+            return ", ".join(messages)
+
+        def drain():
+            for queue, _ in stages:
+                while True:
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        break
+
+        def abort():
+            # consumers killed by a crash or the OOM killer no longer drain
+            # their queues, so drain them here until the preprocessing workers
+            # have stopped, then hand the sentinels to the surviving consumers
+            stop.set()
+            while not preprocess_future.done():
+                drain()
+                wait([preprocess_future], timeout=0.1)
+            drain()
+            for queue, num_consumers in stages:
+                for _ in range(num_consumers):
+                    queue.put_nowait(None)
+
+        stamps = {"f0": (f0_dir, f0_stamp), "features": (feature_dir, feature_stamp)}
+        outputs = {  # Dict[stage name, (clip name) -> List[output path]]
+            "f0": lambda name: [
+                os.path.join(f0_dir, f"{name}.npy"),
+                os.path.join(f0nsf_dir, f"{name}.npy"),
+            ],
+            "features": lambda name: [
+                os.path.join(feature_dir, f"{os.path.splitext(name)[0]}.npy")
+            ],
+        }
+
+        def finish(name: str):
+            # failed clips are only logged by the workers, so leave the stage
+            # unstamped to retry them on the next run
+            missing = [
+                clip
+                for clip in split.list_clips(waves16k_dir)
+                if not all(os.path.exists(path) for path in outputs[name](clip))
+            ]
+            if len(missing) > 0:
+                print(f"{name}: {len(missing)} clips were not extracted")
+                return
+            write_stamp(*stamps[name])
+
+        last_status = None
+        with ThreadPoolExecutor(max_workers=1) as preprocess_executor:
+            preprocess_future = preprocess_executor.submit(preprocess)
+            pending = set(futures) | {preprocess_future}
+            try:
+                while len(pending) > 0:
+                    # poll twice a second, so that the UI is not flooded with updates
+                    done, pending = wait(
+                        pending, timeout=0.5, return_when=FIRST_COMPLETED
+                    )
+                    for future in done:
+                        future.result()
+                        if future is preprocess_future:
+                            write_stamp(waves_dir, preprocess_stamp)
+                            num_clips = len(split.list_clips(waves16k_dir))
+                            continue
+                        name = futures.pop(future)
+                        if name not in futures.values():
+                            finish(name)
+                    message = status()
+                    if message != "" and message != last_status:
+                        yield message
+                        last_status = message
+            except BaseException:
+                abort()
+                raise
@@ -4,6 +4,7 @@ import operator
 import os
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from random import shuffle
 from typing import *
 
@@ -14,6 +15,7 @@ import torch.distributed as dist
 import torch.multiprocessing as mp
 import torchaudio
 import tqdm
+from scipy.io import wavfile
 from sklearn.cluster import MiniBatchKMeans
 from torch.cuda.amp import GradScaler, autocast
 from torch.nn import functional as F
@@ -22,7 +24,7 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
 from . import commons, utils
-from .checkpoints import save
+from .checkpoints import discard_saves, save, wait_for_saves
 from .config import DatasetMetadata, TrainConfig
 from .data_utils import (DistributedBucketSampler, TextAudioCollate,
                          TextAudioCollateMultiNSFsid, TextAudioLoader,
@@ -105,52 +107,126 @@ def create_dataset_meta(training_dir: str, f0: bool):
     co256_dir = os.path.join(training_dir, "3_feature256")
 
     def list_data(dir: str):
-        files = []
-        for subdir in os.listdir(dir):
-            speaker_dir = os.path.join(dir, subdir)
-            for name in os.listdir(speaker_dir):
-                files.append(os.path.join(subdir, name.split(".")[0]))
-        return files
-
-    names = set(list_data(gt_wavs_dir)) & set(list_data(co256_dir))
-
+        return {
+            (speaker.name, entry.name.partition(".")[0])
+            for speaker in os.scandir(dir)
+            if speaker.is_dir()
+            for entry in os.scandir(speaker.path)
+            if not entry.name.startswith(".")
+        }
+
+    data_dirs = [gt_wavs_dir, co256_dir]
     if f0:
         f0_dir = os.path.join(training_dir, "2a_f0")
         f0nsf_dir = os.path.join(training_dir, "2b_f0nsf")
-        names = names & set(list_data(f0_dir)) & set(list_data(f0nsf_dir))
+        data_dirs += [f0_dir, f0nsf_dir]
+
+    # list the directories concurrently to hide filesystem latency
+    with ThreadPoolExecutor(max_workers=len(data_dirs)) as executor:
+        names = set.intersection(*executor.map(list_data, data_dirs))
+
+    gt_wavs_prefix = gt_wavs_dir + os.sep
+    co256_prefix = co256_dir + os.sep
+    if f0:
+        f0_prefix = f0_dir + os.sep
+        f0nsf_prefix = f0nsf_dir + os.sep
 
     meta = {
         "files": {},
     }
 
-    for name in names:
-        speaker_id = os.path.dirname(name).split("_")[0]
-        speaker_id = int(speaker_id) if speaker_id.isdecimal() else 0
+    # parse each speaker directory once rather than once per clip
+    speaker_ids = {}
+    for speaker in set(speaker for speaker, _ in names):
+        speaker_id = speaker.split("_")[0]
+        speaker_ids[speaker] = int(speaker_id) if speaker_id.isdecimal() else 0
+
+    # sorted so that meta.json, and the sampler order it induces, is stable
+    for speaker, stem in sorted(names):
+        name = f"{speaker}{os.sep}{stem}"
+        item = {
+            "gt_wav": f"{gt_wavs_prefix}{name}.wav",
+            "co256": f"{co256_prefix}{name}.npy",
+        }
         if f0:
-            gt_wav_path = os.path.join(gt_wavs_dir, f"{name}.wav")
-            co256_path = os.path.join(co256_dir, f"{name}.npy")
-            f0_path = os.path.join(f0_dir, f"{name}.wav.npy")
-            f0nsf_path = os.path.join(f0nsf_dir, f"{name}.wav.npy")
-            meta["files"][name] = {
-                "gt_wav": gt_wav_path,
-                "co256": co256_path,
-                "f0": f0_path,
-                "f0nsf": f0nsf_path,
-                "speaker_id": speaker_id,
-            }
-        else:
-            gt_wav_path = os.path.join(gt_wavs_dir, f"{name}.wav")
-            co256_path = os.path.join(co256_dir, f"{name}.npy")
-            meta["files"][name] = {
-                "gt_wav": gt_wav_path,
-                "co256": co256_path,
-                "speaker_id": speaker_id,
-            }
-
-    with open(os.path.join(training_dir, "meta.json"), "w") as f:
+            item["f0"] = f"{f0_prefix}{name}.wav.npy"
+            item["f0nsf"] = f"{f0nsf_prefix}{name}.wav.npy"
+        item["speaker_id"] = speaker_ids[speaker]
+        meta["files"][name] = item
+
+    pack_gt_wavs(training_dir, meta["files"])
+
+    with open(
+        os.path.join(training_dir, "meta.json"), "w", buffering=1 << 20
+    ) as f:
         json.dump(meta, f, indent=2)
 
 
+def pack_gt_wavs(training_dir: str, files: Dict[str, Dict[str, Any]]):
+    """
+    Pack the ground truth waves into a few large float32 shards, so that the
+    data loader slices memory-mapped shards instead of opening a small wave
+    file for every sample. Adds "gt_wav_shard" to each item of `files`.
+    """
+    shard_dir = os.path.join(training_dir, "0_gt_wavs_shards")
+    index_path = os.path.join(shard_dir, "index.json")
+    max_shard_bytes = 1 << 30
+
+    names = sorted(files.keys())
+    stats = {}
+    for name in names:
+        stat = os.stat(files[name]["gt_wav"])
+        stats[name] = [stat.st_mtime_ns, stat.st_size]
+
+    index = None
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index["stats"] != stats:
+            index = None
+
+    if index is None:
+        if os.path.exists(shard_dir):
+            shutil.rmtree(shard_dir)
+        os.makedirs(shard_dir)
+
+        index = {"stats": stats, "shards": {}}
+        shard_file = None
+        shard_bytes = max_shard_bytes
+        shard_id = -1
+        with ThreadPoolExecutor() as executor:
+            for i in range(0, len(names), 64):
+                chunk = names[i : i + 64]
+                for name, (sampling_rate, audio) in zip(
+                    chunk,
+                    executor.map(lambda n: wavfile.read(files[n]["gt_wav"]), chunk),
+                ):
+                    audio = audio.astype(np.float32)
+                    if shard_bytes + audio.nbytes > max_shard_bytes:
+                        if shard_file is not None:
+                            shard_file.close()
+                        shard_id += 1
+                        shard_bytes = 0
+                        shard_path = os.path.join(shard_dir, f"shard_{shard_id:03}.bin")
+                        shard_file = open(shard_path, "wb")
+                    index["shards"][name] = {
+                        "path": shard_path,
+                        "offset": shard_bytes // audio.itemsize,
+                        "length": len(audio),
+                        "sampling_rate": sampling_rate,
+                    }
+                    shard_file.write(audio.tobytes())
+                    shard_bytes += audio.nbytes
+        if shard_file is not None:
+            shard_file.close()
+
+        with open(index_path, "w") as f:
+            json.dump(index, f)
+
+    for name in names:
+        files[name]["gt_wav_shard"] = index["shards"][name]
+
+
 def change_speaker(net_g, speaker_info, embedder, embedding_output_layer, phone, phone_lengths, pitch, pitchf, spec_lengths):
     """
     random change formant
@@ -325,6 +401,7 @@ def train_model(
     embedding_output_layer: int,
     save_only_last: bool = False,
     device: Optional[Union[str, torch.device]] = None,
+    num_workers: int = 4,
 ):
     os.environ["MASTER_ADDR"] = "localhost"
     os.environ["MASTER_PORT"] = str(utils.find_empty_port())
@@ -365,6 +442,7 @@ def train_model(
             embedding_output_layer,
             save_only_last,
             device,
+            num_workers,
         )
     else:
         mp.spawn(
@@ -392,6 +470,7 @@ def train_model(
                 embedding_output_layer,
                 save_only_last,
                 device,
+                num_workers,
             ),
         )
 
@@ -431,7 +510,9 @@ def training_runner(
     embedding_output_layer: int,
     save_only_last: bool = False,
     device: Optional[Union[str, torch.device]] = None,
+    num_workers: int = 4,
 ):
+    discard_saves()
     config.train.batch_size = batch_size
     log_dir = os.path.join(training_dir, "logs")
     state_dir = os.path.join(training_dir, "state")
@@ -487,13 +568,13 @@ def training_runner(
 
     train_loader = DataLoader(
         train_dataset,
-        num_workers=4,
+        num_workers=max(1, num_workers),
         shuffle=False,
         pin_memory=True,
         collate_fn=collate_fn,
         batch_sampler=train_sampler,
         persistent_workers=True,
-        prefetch_factor=8,
+        prefetch_factor=4,
     )
     speaker_info = None
     if os.path.exists(os.path.join(training_dir, "speaker_info.json")):
@@ -996,3 +1077,4 @@ def training_runner(
             epoch,
             speaker_info
         )
+        wait_for_saves()
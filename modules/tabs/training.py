@@ -1,11 +1,13 @@
 import math
 import os
 import shutil
+import threading
+import time
 from multiprocessing import cpu_count
 
 import gradio as gr
 
-from lib.rvc.preprocessing import extract_f0, extract_feature, split
+from lib.rvc.preprocessing import stream
 from lib.rvc.train import create_dataset_meta, glob_dataset, train_index, train_model
 from modules import models, utils
 from modules.shared import MODELS_DIR, device, half_support
@@ -17,6 +19,63 @@ SR_DICT = {
     "48k": 48000,
 }
 
+TRAINING_MODELS_DIR = os.path.join(MODELS_DIR, "training", "models")
+TRAINING_TRASH_DIR = os.path.join(MODELS_DIR, "training", ".trash")
+MUTE_WAV_PATHS = {
+    sr: os.path.join(MODELS_DIR, "training", "mute", "0_gt_wavs", f"mute{sr}.wav")
+    for sr in SR_DICT
+}
+
+
+def get_training_dir(model_name: str):
+    # a name that does not resolve to a directory directly under the training
+    # models directory (e.g. "", "." or "..") would make "Ignore cache" delete
+    # other models
+    training_dir = os.path.join(TRAINING_MODELS_DIR, model_name)
+    if model_name.strip() == "" or os.path.dirname(
+        os.path.abspath(training_dir)
+    ) != os.path.abspath(TRAINING_MODELS_DIR):
+        raise Exception(f"Invalid model name: {model_name!r}")
+    return training_dir
+
+
+def remove_in_background(dir: str):
+    threading.Thread(
+        target=shutil.rmtree, args=(dir,), kwargs={"ignore_errors": True}, daemon=True
+    ).start()
+
+
+def remove_training_dir(training_dir: str):
+    # move the directory out of the way and delete it in the background, so
+    # that preprocessing can start right away
+    os.makedirs(TRAINING_TRASH_DIR, exist_ok=True)
+    trash_dir = os.path.join(
+        TRAINING_TRASH_DIR,
+        f"{os.path.basename(training_dir)}_{os.getpid()}_{int(time.time())}",
+    )
+    try:
+        os.rename(training_dir, trash_dir)
+    except OSError:
+        shutil.rmtree(training_dir)
+        return
+    remove_in_background(trash_dir)
+
+
+def remove_trash_dirs():
+    # directories left behind when the process exited before deleting them
+    if not os.path.isdir(TRAINING_TRASH_DIR):
+        return
+    with os.scandir(TRAINING_TRASH_DIR) as entries:
+        for entry in entries:
+            remove_in_background(entry.path)
+
+
+def get_mute_wav_path(sr: str):
+    mute_wav_path = MUTE_WAV_PATHS[sr]
+    if not os.path.exists(mute_wav_path):
+        raise Exception(f"Mute audio not found: {mute_wav_path}")
+    return mute_wav_path
+
 
 class Training(Tab):
     def title(self):
@@ -26,6 +85,8 @@ class Training(Tab):
         return 2
 
     def ui(self, outlet):
+        remove_trash_dirs()
+
         def train_index_only(
             model_name,
             target_sr,
@@ -51,12 +112,13 @@ class Training(Tab):
             norm_audio_when_preprocess = norm_audio_when_preprocess == "Yes"
             run_train_index = run_train_index == "Yes"
             reduce_index_size = reduce_index_size == "Yes"
-            training_dir = os.path.join(MODELS_DIR, "training", "models", model_name)
+            training_dir = get_training_dir(model_name)
             gpu_ids = [int(x.strip()) for x in gpu_id.split(",")] if gpu_id else []
+            mute_wav_path = get_mute_wav_path(target_sr)
             yield f"Training directory: {training_dir}"
 
             if os.path.exists(training_dir) and ignore_cache:
-                shutil.rmtree(training_dir)
+                remove_training_dir(training_dir)
 
             os.makedirs(training_dir, exist_ok=True)
 
@@ -70,28 +132,6 @@ class Training(Tab):
             if len(datasets) == 0:
                 raise Exception("No audio files found")
 
-            yield "Preprocessing..."
-            split.preprocess_audio(
-                datasets,
-                SR_DICT[target_sr],
-                num_cpu_process,
-                training_dir,
-                norm_audio_when_preprocess,
-                os.path.join(
-                    MODELS_DIR,
-                    "training",
-                    "mute",
-                    "0_gt_wavs",
-                    f"mute{target_sr}.wav",
-                ),
-            )
-
-            if f0:
-                yield "Extracting f0..."
-                extract_f0.run(training_dir, num_cpu_process, pitch_extraction_algo)
-
-            yield "Extracting features..."
-
             embedder_filepath, _, embedder_load_from = models.get_embedder(
                 embedder_name
             )
@@ -101,8 +141,15 @@ class Training(Tab):
                     MODELS_DIR, "embeddings", embedder_filepath
                 )
 
-            extract_feature.run(
+            yield from stream.run(
+                datasets,
+                SR_DICT[target_sr],
+                num_cpu_process,
                 training_dir,
+                norm_audio_when_preprocess,
+                mute_wav_path,
+                f0,
+                pitch_extraction_algo,
                 embedder_filepath,
                 embedder_load_from,
                 int(embedding_channels),
@@ -168,11 +215,12 @@ class Training(Tab):
             norm_audio_when_preprocess = norm_audio_when_preprocess == "Yes"
             run_train_index = run_train_index == "Yes"
             reduce_index_size = reduce_index_size == "Yes"
-            training_dir = os.path.join(MODELS_DIR, "training", "models", model_name)
+            training_dir = get_training_dir(model_name)
             gpu_ids = [int(x.strip()) for x in gpu_id.split(",")] if gpu_id else []
+            mute_wav_path = get_mute_wav_path(sampling_rate_str)
 
             if os.path.exists(training_dir) and ignore_cache:
-                shutil.rmtree(training_dir)
+                remove_training_dir(training_dir)
 
             os.makedirs(training_dir, exist_ok=True)
 
@@ -189,28 +237,6 @@ class Training(Tab):
             if len(datasets) == 0:
                 raise Exception("No audio files found")
 
-            yield "Preprocessing..."
-            split.preprocess_audio(
-                datasets,
-                SR_DICT[sampling_rate_str],
-                num_cpu_process,
-                training_dir,
-                norm_audio_when_preprocess,
-                os.path.join(
-                    MODELS_DIR,
-                    "training",
-                    "mute",
-                    "0_gt_wavs",
-                    f"mute{sampling_rate_str}.wav",
-                ),
-            )
-
-            if f0:
-                yield "Extracting f0..."
-                extract_f0.run(training_dir, num_cpu_process, pitch_extraction_algo)
-
-            yield "Extracting features..."
-
             embedder_filepath, _, embedder_load_from = models.get_embedder(
                 embedder_name
             )
@@ -220,8 +246,15 @@ class Training(Tab):
                     MODELS_DIR, "embeddings", embedder_filepath
                 )
 
-            extract_feature.run(
+            yield from stream.run(
+                datasets,
+                SR_DICT[sampling_rate_str],
+                num_cpu_process,
                 training_dir,
+                norm_audio_when_preprocess,
+                mute_wav_path,
+                f0,
+                pitch_extraction_algo,
                 embedder_filepath,
                 embedder_load_from,
                 int(embedding_channels),
@@ -267,6 +300,7 @@ class Training(Tab):
                 int(embedding_output_layer),
                 save_only_last,
                 None if len(gpu_ids) > 1 else device,
+                num_cpu_process,
             )
 
             yield "Training index..."
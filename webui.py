@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 
 from modules import cmd_opts, ui
@@ -23,4 +24,10 @@ def webui():
 
 
 if __name__ == "__main__":
+    # Worker processes must not inherit the CUDA state of this process, so
+    # never fork them (the default on Linux).
+    try:
+        multiprocessing.set_start_method("spawn", force=True)
+    except RuntimeError:
+        pass
     webui()